@@ -22,8 +22,6 @@ import textwrap
 from base64 import b64encode
 from collections import deque
 from collections.abc import MutableMapping, Mapping
-import email
-import email.policy
 from http.client import (HTTPS_PORT, HTTP_PORT, NO_CONTENT, NOT_MODIFIED)
 import select
 try:
@@ -191,7 +189,7 @@ class HTTPResponse:
         #: HTTP reason phrase returned by the server
         self.reason = reason
 
-        #: HTTP Response headers, a `email.message.Message` instance
+        #: HTTP Response headers, a `HTTPHeaders` instance
         self.headers = headers
 
         #: Length of the response body or `None` if not known. This attribute
@@ -487,6 +485,10 @@ class HTTPConnection:
         #: Filehandler for tracing
         self.trace_fh = None
 
+        #: Value of the ``Host`` header for requests on this connection
+        #: (set by `.connect`)
+        self._host_header = None
+
     # Implement bare-bones `io.BaseIO` interface, so that instances
     # can be wrapped in `io.TextIOWrapper` if desired.
     def writable(self):
@@ -519,6 +521,12 @@ class HTTPConnection:
             log.debug('connecting to %s', (self.hostname, self.port))
             self._sock = create_socket((self.hostname, self.port))
 
+        # Request headers and body data are sent separately, and the server
+        # will not respond before it has received both. Nagle's algorithm
+        # would hold back the second part until the first one is
+        # acknowledged (which the server may delay).
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
         if self.ssl_context:
             log.debug('establishing ssl layer')
             if (sys.version_info >= (3, 5) or
@@ -546,6 +554,16 @@ class HTTPConnection:
         self._in_remaining = None
         self._pending_requests = deque()
 
+        # Generate host header
+        host = self.hostname
+        if host.find(':') >= 0:
+            host = '[{}]'.format(host)
+        default_port = HTTPS_PORT if self.ssl_context else HTTP_PORT
+        if self.port == default_port:
+            self._host_header = host
+        else:
+            self._host_header = '{}:{}'.format(host, self.port)
+
         if 'DUGONG_TRACEFILE' in os.environ:
             self.trace_fh = open(os.environ['DUGONG_TRACEFILE'] % id(self._sock),
                                  'wb+', buffering=0)
@@ -664,17 +682,8 @@ class HTTPConnection:
         else:
             raise TypeError('*body* must be None, bytes-like or BodyFollowing')
 
-        # Generate host header
-        host = self.hostname
-        if host.find(':') >= 0:
-            host = '[{}]'.format(host)
-        default_port = HTTPS_PORT if self.ssl_context else HTTP_PORT
-        if self.port == default_port:
-            headers['Host'] = host
-        else:
-            headers['Host'] = '{}:{}'.format(host, self.port)
-
         # Assemble request
+        headers['Host'] = self._host_header
         headers['Accept-Encoding'] = 'identity'
         if 'Connection' not in headers:
             headers['Connection'] = 'keep-alive'
@@ -682,20 +691,21 @@ class HTTPConnection:
             gpath = "http://{}{}".format(headers['Host'], path)
         else:
             gpath = path
-        request = [ '{} {} HTTP/1.1'.format(method, gpath).encode('latin1') ]
+        request = [ '{} {} HTTP/1.1\r\n'.format(method, gpath) ]
         for key, val in headers.items():
-            request.append('{}: {}'.format(key, val).encode('latin1'))
-        request.append(b'')
-
-        if body is not None:
-            request.append(body)
-        else:
-            request.append(b'')
-
-        buf = b'\r\n'.join(request)
+            request.append('{}: {}\r\n'.format(key, val))
+        request.append('\r\n')
+        buf = ''.join(request).encode('latin1')
 
         log.debug('sending %s %s', method, path)
-        yield from self._co_send(buf)
+        if body is None:
+            yield from self._co_send(buf)
+        elif len(body) < BUFFER_SIZE:
+            yield from self._co_send(buf + body)
+        else:
+            # Avoid copying large bodies just to prepend the header
+            yield from self._co_send(buf)
+            yield from self._co_send(body)
         if not self._out_remaining or expect100:
             self._pending_requests.append((method, path, pending_body_size))
 
@@ -822,8 +832,7 @@ class HTTPConnection:
             (status, reason) = yield from self._co_read_status()
             log.debug('got %03d %s', status, reason)
 
-            hstring = yield from self._co_read_header()
-            header = email.message_from_string(hstring, policy=email.policy.HTTP)
+            header = yield from self._co_read_header()
 
             if status < 100 or status > 199:
                 break
@@ -884,9 +893,10 @@ class HTTPConnection:
         # the next call to co_read() et al - that way we can still
         # return the http status and headers.
 
-        will_close = header.get('Connection', 'keep-alive').lower() == 'close'
+        # Repeated fields are combined into comma-separated lists
+        will_close = 'close' in _split_tokens(header.get('Connection', 'keep-alive'))
 
-        body_length = header['Content-Length']
+        body_length = header.get('Content-Length', None)
         if body_length is not None:
             try:
                 body_length = int(body_length)
@@ -903,7 +913,15 @@ class HTTPConnection:
             self._encoding = None
             return 0
 
-        tc = header.get('Transfer-Encoding', 'identity').lower()
+        codings = [ x for x in _split_tokens(header.get('Transfer-Encoding', ''))
+                    if x != 'identity' ]
+        if not codings:
+            tc = 'identity'
+        elif all(x == 'chunked' for x in codings):
+            tc = 'chunked'
+        else:
+            tc = ', '.join(codings)
+
         if tc == 'chunked':
             log.debug('Chunked encoding detected')
             self._encoding = Encodings.CHUNKED
@@ -970,7 +988,7 @@ class HTTPConnection:
         return (status, reason.strip())
 
     def _co_read_header(self):
-        '''Read response header'''
+        '''Read response header and return it as `HTTPHeaders`'''
 
         log.debug('start')
 
@@ -982,7 +1000,7 @@ class HTTPConnection:
         if rbuf.d[rbuf.b:rbuf.b+2] == b'\r\n':
             log.debug('done (empty header)')
             rbuf.b += 2
-            return ''
+            return HTTPHeaders()
 
         try:
             hstring = yield from self._co_readstr_until(b'\r\n\r\n', MAX_HEADER_SIZE)
@@ -990,7 +1008,7 @@ class HTTPConnection:
             raise InvalidResponse('server sent ridicously long header')
 
         log.debug('done (%d characters)', len(hstring))
-        return hstring
+        return _parse_header(hstring)
 
     def read(self, len_=None):
         '''placeholder, will be replaced dynamically'''
@@ -1528,6 +1546,68 @@ else:
     def _join(parts):
         return b''.join(parts)
 
+def _split_tokens(value):
+    '''Return list of lower-cased tokens in comma-separated header *value*'''
+
+    return [ x.strip() for x in value.lower().split(',') if x.strip() ]
+
+def _parse_header(hstring):
+    '''Parse response header in *hstring* into a `HTTPHeaders` instance
+
+    Folded (multi-line) fields are joined into one line. Lines that are not
+    valid header fields are logged and ignored. See `HTTPHeaders` for the
+    handling of fields that occur more than once.
+    '''
+
+    header = HTTPHeaders()
+    store = header._store
+    all_values = header._all
+    lname = None
+    for line in hstring.split('\r\n'):
+        if not line:
+            continue
+        if line[0] in ' \t':
+            if lname is None:
+                log.warning('Ignoring header continuation line without field: %r',
+                            line[:80])
+                continue
+            cont = ' ' + line.strip()
+            values = all_values.get(lname, None)
+            if values is not None:
+                values[-1] += cont
+            if values is None or lname not in _UNCOMBINED_FIELDS:
+                (name, value) = store[lname]
+                store[lname] = (name, value + cont)
+            continue
+
+        (name, sep, value) = line.partition(':')
+        name = name.strip()
+        if not sep or not name:
+            log.warning('Ignoring malformed header line: %r', line[:80])
+            lname = None
+            continue
+        value = value.strip()
+        lname = name.lower()
+
+        if lname not in store:
+            store[lname] = (name, value)
+            continue
+
+        values = all_values.get(lname, None)
+        if values is None:
+            values = all_values[lname] = [store[lname][1]]
+        values.append(value)
+
+        if lname in _UNCOMBINED_FIELDS:
+            continue
+        elif lname == 'content-length' and value == store[lname][1]:
+            # Identical duplicates are permitted (RFC 7230, sec. 3.3.2),
+            # different values make the field (and response) invalid.
+            continue
+        store[lname] = (store[lname][0], store[lname][1] + ', ' + value)
+
+    return header
+
 def eval_coroutine(crt, timeout=None):
     '''Evaluate *crt* (polling as needed) and return its result
 
@@ -1599,6 +1679,16 @@ def create_socket(address):
         raise HostnameNotResolvable(address[0])
 
 
+#: Error codes that `is_temp_network_error` considers temporary. We have to be
+#: careful when retrieving errno codes, because not all of them may exist on
+#: every platform.
+_TEMP_ERRNOS = frozenset(getattr(errno, errcode) for errcode in
+                         ('EHOSTDOWN', 'EHOSTUNREACH', 'ENETDOWN',
+                          'ENETRESET', 'ENETUNREACH', 'ENOLINK',
+                          'ENONET', 'ENOTCONN', 'ENXIO', 'EPIPE',
+                          'EREMCHG', 'ESHUTDOWN', 'ETIMEDOUT', 'EAGAIN')
+                         if hasattr(errno, errcode))
+
 def is_temp_network_error(exc):
     '''Return true if *exc* represents a potentially temporary network problem
 
@@ -1613,17 +1703,7 @@ def is_temp_network_error(exc):
         return True
 
     elif isinstance(exc, OSError):
-        # We have to be careful when retrieving errno codes, because
-        # not all of them may exist on every platform.
-        for errcode in ('EHOSTDOWN', 'EHOSTUNREACH', 'ENETDOWN',
-                        'ENETRESET', 'ENETUNREACH', 'ENOLINK',
-                        'ENONET', 'ENOTCONN', 'ENXIO', 'EPIPE',
-                        'EREMCHG', 'ESHUTDOWN', 'ETIMEDOUT', 'EAGAIN'):
-            try:
-                if getattr(errno, errcode) == exc.errno:
-                    return True
-            except AttributeError:
-                pass
+        return exc.errno in _TEMP_ERRNOS
 
     return False
 
@@ -1653,11 +1733,20 @@ class CaseInsensitiveDict(MutableMapping):
     is undefined.
     """
 
+    __slots__ = ('_store',)
+
     def __init__(self, data=None, **kwargs):
-        self._store = dict()
         if data is None:
-            data = {}
-        self.update(data, **kwargs)
+            self._store = dict()
+        elif isinstance(data, dict):
+            # Common case, avoid going through MutableMapping.update
+            self._store = { key.lower(): (key, value)
+                            for (key, value) in data.items() }
+        else:
+            self._store = dict()
+            self.update(data)
+        if kwargs:
+            self.update(kwargs)
 
     def __setitem__(self, key, value):
         # Use the lowercased key for lookups, but store the actual
@@ -1685,19 +1774,98 @@ class CaseInsensitiveDict(MutableMapping):
         )
 
     def __eq__(self, other):
-        if isinstance(other, Mapping):
-            other = CaseInsensitiveDict(other)
+        if isinstance(other, CaseInsensitiveDict):
+            # Compare stored values directly, without building any
+            # intermediate dicts
+            if len(self._store) != len(other._store):
+                return False
+            other_store = other._store
+            for (lowerkey, keyval) in self._store.items():
+                try:
+                    if other_store[lowerkey][1] != keyval[1]:
+                        return False
+                except KeyError:
+                    return False
+            return True
+        elif isinstance(other, Mapping):
+            # Look up each key of *other* in our store, without creating
+            # a CaseInsensitiveDict copy of it
+            if len(self._store) != len(other):
+                return False
+            store = self._store
+            for (key, value) in other.items():
+                keyval = store.get(key.lower(), None)
+                if keyval is None or keyval[1] != value:
+                    return False
+            return True
         else:
             return NotImplemented
-        # Compare insensitively
-        return dict(self.lower_items()) == dict(other.lower_items())
 
     # Copy is required
     def copy(self):
-         return CaseInsensitiveDict(self._store.values())
+        # Keys have already been lowercased, so copy the store directly
+        new = CaseInsensitiveDict.__new__(CaseInsensitiveDict)
+        new._store = self._store.copy()
+        return new
 
     def __repr__(self):
-        return '%s(%r)' % (self.__class__.__name__, dict(self.items()))
+        return '%s({%s})' % (self.__class__.__name__,
+                             ', '.join('%r: %r' % keyval
+                                       for keyval in self._store.values()))
+
+#: Header fields that must not be combined into a comma-separated
+#: value when they are sent more than once (cf. RFC 7230, sec. 3.2.2)
+_UNCOMBINED_FIELDS = frozenset(('set-cookie',))
+
+class HTTPHeaders(CaseInsensitiveDict):
+    """A `CaseInsensitiveDict` holding HTTP response header fields.
+
+    If a field occurs more than once in the response, item access returns
+    the values combined into a single comma-separated string (cf. RFC 7230,
+    sec. 3.2.2). The exceptions are ``Set-Cookie``, for which the first
+    value is returned, and ``Content-Length``, for which identical
+    duplicates are collapsed into one value. Use :meth:`get_all` to
+    retrieve the individual values.
+    """
+
+    __slots__ = ('_all',)
+
+    def __init__(self, data=None, **kwargs):
+        #: Maps lower-cased field names to the list of values for all
+        #: fields that occured more than once
+        self._all = dict()
+        super().__init__(data, **kwargs)
+
+    def __setitem__(self, key, value):
+        lkey = key.lower()
+        self._all.pop(lkey, None)
+        self._store[lkey] = (key, value)
+
+    def __delitem__(self, key):
+        lkey = key.lower()
+        del self._store[lkey]
+        self._all.pop(lkey, None)
+
+    def get_all(self, name, failobj=None):
+        '''Return list of all values for header field *name*
+
+        If there is no such field, return *failobj*.
+        '''
+
+        lname = name.lower()
+        values = self._all.get(lname, None)
+        if values is not None:
+            return list(values)
+        keyval = self._store.get(lname, None)
+        if keyval is None:
+            return failobj
+        return [keyval[1]]
+
+    def copy(self):
+        new = HTTPHeaders.__new__(HTTPHeaders)
+        new._store = self._store.copy()
+        new._all = { k: list(v) for (k, v) in self._all.items() }
+        return new
 
 
 if asyncio:
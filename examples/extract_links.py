@@ -7,7 +7,7 @@ import sys
 import os.path
 from io import TextIOWrapper
 from html.parser import HTMLParser
-from urllib.parse import urlsplit, urljoin, urlunsplit
+from urllib.parse import urlsplit, urljoin
 import re
 import ssl
 
@@ -28,13 +28,19 @@ if os.path.exists(os.path.join(basedir, '.hg')):
     import warnings
     warnings.simplefilter('error')
 
+# Content-Type header of an HTML document, optionally with charset parameter
+HTML_CONTENT_TYPE_RE = re.compile(r'text/x?html(?:; charset=(.+))?$')
+
 class LinkExtractor(HTMLParser):
     def __init__(self):
         if sys.version_info < (3,4):
             # Python 3.3 doesn't know about convert_charrefs
             super().__init__()
         else:
-            super().__init__(convert_charrefs=True)
+            # We only look at attribute values (which are always
+            # unescaped), so there is no point in converting character
+            # references in the text data.
+            super().__init__(convert_charrefs=False)
         self.links = []
 
     def handle_starttag(self, tag, attrs):
@@ -44,7 +50,7 @@ class LinkExtractor(HTMLParser):
         for (name, val) in attrs:
             if name == 'href':
                 self.links.append(val)
-            break
+                break
 
 def main():
     if len(sys.argv) != 2:
@@ -53,16 +59,22 @@ def main():
     url_els = urlsplit(url)
 
     if url_els.scheme == 'https':
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-        ssl_context.options |= ssl.OP_NO_SSLv2
-        ssl_context.verify_mode = ssl.CERT_REQUIRED
-        ssl_context.set_default_verify_paths()
+        if hasattr(ssl, 'create_default_context'):
+            # Python 3.4+
+            ssl_context = ssl.create_default_context()
+        else:
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            ssl_context.options |= ssl.OP_NO_SSLv2
+            ssl_context.verify_mode = ssl.CERT_REQUIRED
+            ssl_context.set_default_verify_paths()
     else:
         ssl_context = None
 
     with HTTPConnection(url_els.hostname, port=url_els.port,
                           ssl_context=ssl_context) as conn:
-        path = urlunsplit(('', '') + url_els[2:4] + ('',)) or '/'
+        path = url_els.path or '/'
+        if url_els.query:
+            path += '?' + url_els.query
         conn.send_request('GET', path)
         resp = conn.read_response()
         if resp.status != 200:
@@ -75,7 +87,7 @@ def main():
         else:
             type_ = resp.headers['Content-Type']
 
-        hit = re.match(r'text/x?html(?:; charset=(.+))?$', type_)
+        hit = HTML_CONTENT_TYPE_RE.match(type_)
         if not hit:
             raise SystemExit('Server did not send html but %s' % type_)
 
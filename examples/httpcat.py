@@ -6,7 +6,6 @@ Retrieve a list of URLs and print them to stdout.
 import sys
 import os.path
 from io import TextIOWrapper
-import re
 from urllib.parse import urlsplit
 
 # We are running from the dugong source directory, append it to module path so
@@ -24,18 +23,50 @@ if os.path.exists(os.path.join(basedir, '.hg')):
     import warnings
     warnings.simplefilter('error')
 
-from dugong import HTTPConnection, BUFFER_SIZE
+from dugong import HTTPConnection, ConnectionClosed, BUFFER_SIZE
 
-for arg in sys.argv[1:]:
-    url = urlsplit(arg)
-    assert url.scheme == 'http'
-    path = url.path
-    if url.query:
-        path += '?' + url.query
+def parse_content_type(type_):
+    '''Split Content-Type header value into media type and charset
 
-    with HTTPConnection(url.hostname, url.port) as conn:
-        conn.send_request('GET', path)
-        resp = conn.read_response()
+    The charset is `None` if the header does not specify one.
+    '''
+
+    (media_type, _, params) = type_.partition(';')
+    for param in params.split(';'):
+        (name, _, value) = param.partition('=')
+        if name.strip().lower() == 'charset':
+            return (media_type.strip(), value.strip().strip('"'))
+    return (media_type.strip(), None)
+
+# Connections are kept open, so that subsequent URLs on the same server
+# can reuse them
+conns = dict()
+
+# Binary data is read directly into this buffer
+bin_buf = memoryview(bytearray(BUFFER_SIZE))
+
+try:
+    for arg in sys.argv[1:]:
+        url = urlsplit(arg)
+        assert url.scheme == 'http'
+        path = url.path
+        if url.query:
+            path += '?' + url.query
+
+        conn = conns.get((url.hostname, url.port), None)
+        if conn is None:
+            conn = HTTPConnection(url.hostname, url.port)
+            conns[(url.hostname, url.port)] = conn
+
+        try:
+            conn.send_request('GET', path)
+            resp = conn.read_response()
+        except ConnectionClosed:
+            # The server may have closed the connection after the previous
+            # response, so retry once with a fresh connection.
+            conn.reset()
+            conn.send_request('GET', path)
+            resp = conn.read_response()
         if resp.status != 200:
             raise SystemExit('%d %s' % (resp.status, resp.reason))
 
@@ -46,27 +77,28 @@ for arg in sys.argv[1:]:
         else:
             type_ = resp.headers['Content-Type']
 
-        hit = re.match(r'(.+?)(?:; charset=(.+))?$', type_)
-        if not hit:
-            raise SystemExit('Unable to parse content-type: %s' % type_)
-        if hit.group(2):
-            charset = hit.group(2)
-        elif hit.group(1).startswith('text/'):
+        (media_type, charset) = parse_content_type(type_)
+        if not charset and media_type.startswith('text/'):
             charset = 'latin1'
-        else:
-            charset = None # binary data
 
         if charset:
+            # Text data
             instream = TextIOWrapper(conn, encoding=charset)
-            outstream = sys.stdout
+            while True:
+                buf = instream.read(BUFFER_SIZE)
+                if not buf:
+                    break
+                sys.stdout.write(buf)
         else:
-            instream = conn
             # Since we're writing bytes rather than text, we need to bypass
-            # any encoding.
-            outstream = sys.stdout.raw
-
-        while True:
-            buf = instream.read(BUFFER_SIZE)
-            if not buf:
-                break
-            outstream.write(buf)
+            # any encoding (but preserve the order with any text written
+            # before).
+            sys.stdout.flush()
+            while True:
+                len_ = conn.readinto(bin_buf)
+                if not len_:
+                    break
+                sys.stdout.buffer.write(bin_buf[:len_])
+finally:
+    for conn in conns.values():
+        conn.disconnect()
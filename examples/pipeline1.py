@@ -2,7 +2,7 @@
 
 import sys
 import os.path
-from urllib.parse import urlsplit, urlunsplit
+from urllib.parse import urlsplit
 
 # We are running from the dugong source directory, append it to module path so
 # that we can fallback on it if dugong hasn't been installed yet.
@@ -31,7 +31,10 @@ for url in sys.argv[1:]:
         raise SystemExit('Can only pipeline to one host')
     if o.scheme != 'http':
         raise SystemExit('Can only do http')
-    path_list.append(urlunsplit(('', '') + o[2:4] + ('',)))
+    path = o.path
+    if o.query:
+        path += '?' + o.query
+    path_list.append(path)
 
 
 # Code from here on is included in documentation
@@ -53,15 +56,14 @@ with HTTPConnection(hostname, port) as conn:
             yield from conn.co_send_request('GET', path)
 
     # This generator function returns a coroutine that reads
-    # all the responses
+    # all the responses and writes each body to stdout as soon
+    # as it has been received
     def read_responses():
-        bodies = []
         for path in path_list:
             resp = yield from conn.co_read_response()
             assert resp.status == 200
             buf = yield from conn.co_readall()
-            bodies.append(buf)
-        return bodies
+            sys.stdout.buffer.write(buf)
 
     # Create the coroutines
     send_crt = send_requests()
@@ -75,7 +77,7 @@ with HTTPConnection(hostname, port) as conn:
     # implies that all the requests must have been sent as well):
     loop.run_until_complete(recv_future)
 
-    # Get the result returned by the coroutine
-    bodies = recv_future.result()
+    # Re-raise any exception that occured in the coroutine
+    recv_future.result()
 
 # end-example
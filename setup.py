@@ -4,6 +4,7 @@ import sys
 import os.path
 import warnings
 import subprocess
+import re
 
 try:
     import setuptools
@@ -33,13 +34,13 @@ def main():
 
     with open(os.path.join(basedir, 'README.rst'), 'r') as fh:
         long_desc = fh.read()
-    import dugong
+    version = get_version()
 
     setuptools.setup(
           name='dugong',
           zip_safe=True,
           long_description=long_desc,
-          version=dugong.__version__,
+          version=version,
           description=('A HTTP 1.1 client module supporting asynchronous IO, pipelining '
                        'and `Expect: 100-continue`. Designed for RESTful protocols.'),
           author='Nikolaus Rath',
@@ -59,11 +60,22 @@ def main():
           tests_require=['pytest >= 3.4.0'],
           cmdclass={'upload_docs': upload_docs },
           command_options={ 'sdist': { 'formats': ('setup.py', 'bztar') } ,
-                            'build_sphinx': {'version': ('setup.py', dugong.__version__),
-                                             'release': ('setup.py', dugong.__version__) }},
+                            'build_sphinx': {'version': ('setup.py', version),
+                                             'release': ('setup.py', version) }},
      )
 
 
+def get_version():
+    '''Read version from dugong/__init__.py without importing it'''
+
+    with open(os.path.join(basedir, 'dugong', '__init__.py'), 'r',
+              encoding='utf-8') as fh:
+        for line in fh:
+            hit = re.match(r"^__version__ = '(.+)'$", line)
+            if hit:
+                return hit.group(1)
+    raise RuntimeError('Unable to determine dugong version')
+
 def fix_docutils():
     '''Work around https://bitbucket.org/birkenfeld/sphinx/issue/1154/'''
 
@@ -24,11 +24,14 @@ if __name__ == '__main__':
 from dugong import (HTTPConnection, BodyFollowing, CaseInsensitiveDict, _join,
                     ConnectionClosed)
 import dugong
+from pytest_checklogs import assert_logs
 from http.server import BaseHTTPRequestHandler
 from io import TextIOWrapper
 from base64 import b64encode
 import http.client
 import itertools
+import random
+import functools
 import pytest
 import time
 import ssl
@@ -36,8 +39,10 @@ import re
 import os
 import html
 import hashlib
+import errno
 import threading
 import socketserver
+import socket
 from pytest import raises as assert_raises
 
 # We want to test with a real certificate
@@ -45,8 +50,14 @@ SSL_TEST_HOST = 'www.google.com'
 
 TEST_DIR = os.path.dirname(__file__)
 
-class HTTPServer(socketserver.TCPServer):
+class HTTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     # Extended to add SSL support
+
+    # Handle each connection in its own thread, so that a handler that is
+    # still busy with the connection of a previous test does not delay the
+    # next one.
+    daemon_threads = True
+
     def get_request(self):
         (sock, addr) = super().get_request()
         if self.ssl_context:
@@ -63,8 +74,12 @@ class HTTPServerThread(threading.Thread):
         self.use_ssl = use_ssl
 
         if use_ssl:
-            ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-            ssl_context.options |= ssl.OP_NO_SSLv2
+            if hasattr(ssl, 'PROTOCOL_TLS_SERVER'):
+                # Python 3.6+, negotiates the best available TLS version
+                ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            else:
+                ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+                ssl_context.options |= ssl.OP_NO_SSLv2
             ssl_context.verify_mode = ssl.CERT_NONE
             ssl_context.load_cert_chain(os.path.join(TEST_DIR, 'server.crt'),
                                         os.path.join(TEST_DIR, 'server.key'))
@@ -73,7 +88,7 @@ class HTTPServerThread(threading.Thread):
             self.httpd.ssl_context = None
 
     def run(self):
-        self.httpd.serve_forever()
+        self.httpd.serve_forever(poll_interval=0.05)
 
     def shutdown(self):
         self.httpd.shutdown()
@@ -105,13 +120,28 @@ def http_server(request):
     request.addfinalizer(httpd.shutdown)
     return httpd
 
+@functools.lru_cache(maxsize=None)
+def get_client_ssl_context():
+    '''Return SSL context for connecting to the test server
+
+    The context is created only once, so that the CA certificate does not
+    have to be loaded again for every test.
+    '''
+
+    if hasattr(ssl, 'PROTOCOL_TLS_CLIENT'):
+        # Python 3.6+, negotiates the best available TLS version
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    else:
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        ssl_context.options |= ssl.OP_NO_SSLv2
+    ssl_context.verify_mode = ssl.CERT_REQUIRED
+    ssl_context.load_verify_locations(cafile=os.path.join(TEST_DIR, 'ca.crt'))
+    return ssl_context
+
 @pytest.fixture()
 def conn(request, http_server):
     if http_server.use_ssl:
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-        ssl_context.options |= ssl.OP_NO_SSLv2
-        ssl_context.verify_mode = ssl.CERT_REQUIRED
-        ssl_context.load_verify_locations(cafile=os.path.join(TEST_DIR, 'ca.crt'))
+        ssl_context = get_client_ssl_context()
     else:
         ssl_context = None
     conn = HTTPConnection(http_server.host, port=http_server.port,
@@ -119,14 +149,32 @@ def conn(request, http_server):
     request.addfinalizer(conn.disconnect)
     return conn
 
+class RandomData:
+    '''Source of random data with a file-like `read` method
+
+    Data is generated only once and then returned from random offsets, so
+    that reading does not require a system call every time.
+    '''
+
+    def __init__(self, size=1024*1024):
+        self.data = os.urandom(size)
+
+    def read(self, len_):
+        assert len_ <= len(self.data)
+        off = random.randrange(len(self.data) - len_ + 1)
+        return self.data[off:off+len_]
+
 @pytest.fixture(scope='module')
-def random_fh(request):
-    fh = open('/dev/urandom', 'rb')
-    request.addfinalizer(fh.close)
-    return fh
+def random_fh():
+    return RandomData()
 
+@pytest.fixture(scope='session')
 def check_http_connection():
-    '''Skip test if we can't connect to ssl test server'''
+    '''Skip test if we can't connect to ssl test server
+
+    The result is shared by all tests that use this fixture, so the server
+    is only contacted once per session.
+    '''
 
     ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
     ssl_context.options |= ssl.OP_NO_SSLv2
@@ -142,9 +190,7 @@ def check_http_connection():
     finally:
         conn.close()
 
-def test_connect_ssl():
-    check_http_connection()
-
+def test_connect_ssl(check_http_connection):
     ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
     ssl_context.options |= ssl.OP_NO_SSLv2
     ssl_context.verify_mode = ssl.CERT_REQUIRED
@@ -158,9 +204,7 @@ def test_connect_ssl():
     conn.discard()
     conn.disconnect()
 
-def test_invalid_ssl():
-    check_http_connection()
-
+def test_invalid_ssl(check_http_connection):
     # Don't load certificates
     context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
     context.options |= ssl.OP_NO_SSLv2
@@ -293,17 +337,26 @@ def get_chunked_GET_handler(path, chunks, delay=None):
         self.send_header("Content-Type", 'application/octet-stream')
         self.send_header("Transfer-Encoding", 'chunked')
         self.end_headers()
+        if not delay:
+            # Send all chunks in a single write
+            body = b''.join(('%x\r\n' % chunk_size).encode('us-ascii')
+                            + DUMMY_DATA[:chunk_size] + b'\r\n'
+                            for chunk_size in chunks)
+            self.wfile.write(body + b'0\r\n\r\n')
+            return
+
+        # Split chunks across several writes, with pauses in between
         for (i, chunk_size) in enumerate(chunks):
-            if i % 3 == 0 and delay:
+            if i % 3 == 0:
                 time.sleep(delay*1e-3)
             self.wfile.write(('%x\r\n' % chunk_size).encode('us-ascii'))
-            if i % 3 == 1 and delay:
+            if i % 3 == 1:
                 self.wfile.write(DUMMY_DATA[:chunk_size//2])
                 time.sleep(delay*1e-3)
                 self.wfile.write(DUMMY_DATA[chunk_size//2:chunk_size])
             else:
                 self.wfile.write(DUMMY_DATA[:chunk_size])
-            if i % 3 == 2 and delay:
+            if i % 3 == 2:
                 time.sleep(delay*1e-3)
             self.wfile.write(b'\r\n')
             self.wfile.flush()
@@ -349,6 +402,10 @@ def test_blocking_send(conn, random_fh, monkeypatch):
         self.wfile.write(random_fh.read(out_len))
     monkeypatch.setattr(MockRequestHandler, 'do_GET', do_GET)
 
+    # Use a small send buffer, so that we block after fewer requests
+    conn.connect()
+    conn._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16*1024)
+
     for count in itertools.count():
         crt = conn.co_send_request('GET', path, body=random_fh.read(in_len))
         flag = False
@@ -358,7 +415,7 @@ def test_blocking_send(conn, random_fh, monkeypatch):
                 break
         if flag:
             break
-        if count > 1000000:
+        if count > 10000:
             pytest.fail("no blocking even after %d requests!?" % count)
 
     # Read responses
@@ -633,8 +690,8 @@ def test_readinto_identity(conn):
     assert resp.path == '/send_512_bytes'
     assert resp.length == 512
     parts = []
+    buf = bytearray(600)
     while True:
-        buf = bytearray(600)
         len_ = conn.readinto(buf)
         if not len_:
             break
@@ -678,14 +735,16 @@ def test_readinto_chunked(conn, monkeypatch):
     assert resp.status == 200
     assert resp.length is None
     assert resp.path == path
-    parts = []
+    expected = b''.join(DUMMY_DATA[:x] for x in chunks)
+    buf = bytearray(len(expected) + 100)
+    view = memoryview(buf)
+    pos = 0
     while True:
-        buf = bytearray(600)
-        len_ = conn.readinto(buf)
+        len_ = conn.readinto(view[pos:pos+600])
         if not len_:
             break
-        parts.append(buf[:len_])
-    assert _join(parts) == b''.join(DUMMY_DATA[:x] for x in chunks)
+        pos += len_
+    assert buf[:pos] == expected
     assert not conn.response_pending()
 
 def test_double_read(conn):
@@ -806,6 +865,17 @@ def test_put(conn):
     assert resp.status == 400
     assert resp.reason.startswith('MD5 mismatch')
 
+def test_put_large(conn):
+    # Large bodies are not sent together with the request header
+    data = DUMMY_DATA * 3
+    assert len(data) > dugong.BUFFER_SIZE
+    conn.send_request('PUT', '/allgood', body=data)
+    resp = conn.read_response()
+    conn.discard()
+    assert resp.status == 204
+    assert resp.length == 0
+    assert resp.reason == 'MD5 matched'
+
 def test_put_separate(conn):
     data = DUMMY_DATA
     conn.send_request('PUT', '/allgood', body=BodyFollowing(len(data)))
@@ -903,6 +973,7 @@ def test_100cont_3(conn, monkeypatch):
 
 def test_aborted_write1(conn, monkeypatch, random_fh):
     BUFSIZE = 64*1024
+    MAX_BLOCKS = 5000
 
     # monkeypatch request handler
     def do_PUT(self):
@@ -914,15 +985,16 @@ def test_aborted_write1(conn, monkeypatch, random_fh):
     monkeypatch.setattr(MockRequestHandler, 'do_PUT', do_PUT)
 
     # Send request
-    conn.send_request('PUT', '/big_object', body=BodyFollowing(BUFSIZE*50),
+    conn.send_request('PUT', '/big_object', body=BodyFollowing(BUFSIZE*MAX_BLOCKS),
                       expect100=True)
     resp = conn.read_response()
     assert resp.status == 100
     assert resp.length == 0
 
-    # Try to write data
+    # Try to write data. Keep going until the connection reset is noticed,
+    # socket buffers may be able to absorb quite a lot of data before that.
     with pytest.raises(ConnectionClosed):
-        for _ in range(50):
+        for _ in range(MAX_BLOCKS):
             conn.write(random_fh.read(BUFSIZE))
 
     # Nevertheless, try to read response
@@ -932,6 +1004,7 @@ def test_aborted_write1(conn, monkeypatch, random_fh):
 
 def test_aborted_write2(conn, monkeypatch, random_fh):
     BUFSIZE = 64*1024
+    MAX_BLOCKS = 5000
 
     # monkeypatch request handler
     def do_PUT(self):
@@ -941,15 +1014,16 @@ def test_aborted_write2(conn, monkeypatch, random_fh):
     monkeypatch.setattr(MockRequestHandler, 'do_PUT', do_PUT)
 
     # Send request
-    conn.send_request('PUT', '/big_object', body=BodyFollowing(BUFSIZE*50),
+    conn.send_request('PUT', '/big_object', body=BodyFollowing(BUFSIZE*MAX_BLOCKS),
                       expect100=True)
     resp = conn.read_response()
     assert resp.status == 100
     assert resp.length == 0
 
-    # Try to write data
+    # Try to write data. Keep going until the connection reset is noticed,
+    # socket buffers may be able to absorb quite a lot of data before that.
     with pytest.raises(ConnectionClosed):
-        for _ in range(50):
+        for _ in range(MAX_BLOCKS):
             conn.write(random_fh.read(BUFSIZE))
 
     # Nevertheless, try to read response
@@ -1006,6 +1080,181 @@ def test_head(conn, monkeypatch):
     assert resp.status == 317
     assert len(conn.readall()) == 0
 
+def test_header_fields(conn, monkeypatch):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", '0')
+        self.send_header("X-Repeated", 'one')
+        self.send_header("x-repeated", 'two')
+        self.send_header("X-Folded", 'first\r\n  second')
+        self.end_headers()
+    monkeypatch.setattr(MockRequestHandler, 'do_GET', do_GET)
+
+    conn.send_request('GET', '/whatever')
+    resp = conn.read_response()
+    assert resp.status == 200
+    assert resp.headers['x-repeated'] == 'one, two'
+    assert resp.headers['X-FOLDED'] == 'first second'
+    assert resp.headers['server'].startswith('MockHTTP')
+    assert 'Content-Type' not in resp.headers
+    assert resp.headers.get_all('X-Repeated') == ['one', 'two']
+    assert resp.headers.get_all('server') == [resp.headers['server']]
+    assert resp.headers.get_all('Content-Type') is None
+    assert not conn.response_pending()
+
+def test_set_cookie(conn, monkeypatch):
+    cookies = ('a=1; Expires=Wed, 21 Oct 2015 07:28:00 GMT', 'b=2')
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", '0')
+        for cookie in cookies:
+            self.send_header("Set-Cookie", cookie)
+        self.end_headers()
+    monkeypatch.setattr(MockRequestHandler, 'do_GET', do_GET)
+
+    conn.send_request('GET', '/whatever')
+    resp = conn.read_response()
+    assert resp.status == 200
+    assert resp.headers['Set-Cookie'] == cookies[0]
+    assert resp.headers.get_all('set-cookie') == list(cookies)
+
+def test_duplicate_content_length(conn, monkeypatch):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", '5')
+        self.send_header("Content-Length", '5')
+        self.end_headers()
+        self.wfile.write(b'hello')
+    monkeypatch.setattr(MockRequestHandler, 'do_GET', do_GET)
+
+    conn.send_request('GET', '/whatever')
+    resp = conn.read_response()
+    assert resp.status == 200
+    assert resp.length == 5
+    assert resp.headers['Content-Length'] == '5'
+    assert conn.readall() == b'hello'
+    assert not conn.response_pending()
+
+def test_duplicate_connection_close(conn, monkeypatch):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Connection", 'close')
+        self.send_header("Connection", 'close')
+        self.end_headers()
+        self.wfile.write(b'hello')
+        self.close_connection = True
+    monkeypatch.setattr(MockRequestHandler, 'do_GET', do_GET)
+
+    conn.send_request('GET', '/whatever')
+    resp = conn.read_response()
+    assert resp.status == 200
+    assert resp.length is None
+    assert conn.readall() == b'hello'
+    assert not conn.response_pending()
+
+def test_duplicate_transfer_encoding(conn, monkeypatch):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Transfer-Encoding", 'chunked')
+        self.send_header("Transfer-Encoding", 'chunked')
+        self.end_headers()
+        self.wfile.write(b'5\r\nhello\r\n0\r\n\r\n')
+    monkeypatch.setattr(MockRequestHandler, 'do_GET', do_GET)
+
+    conn.send_request('GET', '/whatever')
+    resp = conn.read_response()
+    assert resp.status == 200
+    assert conn.readall() == b'hello'
+    assert not conn.response_pending()
+
+def test_conflicting_content_length(conn, monkeypatch):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", '5')
+        self.send_header("Content-Length", '6')
+        self.send_header("Connection", 'close')
+        self.end_headers()
+        self.wfile.write(b'hello!')
+        self.close_connection = True
+    monkeypatch.setattr(MockRequestHandler, 'do_GET', do_GET)
+
+    conn.send_request('GET', '/whatever')
+    resp = conn.read_response()
+    assert resp.status == 200
+    assert resp.headers.get_all('Content-Length') == ['5', '6']
+    with pytest.raises(dugong.InvalidResponse):
+        conn.read()
+    conn.disconnect()
+
+def test_malformed_header_line(conn, monkeypatch):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("X-Before", 'one')
+        self._headers_buffer.append(b'no colon here\r\n')
+        self.send_header("Content-Length", '5')
+        self.send_header("X-After", 'two')
+        self.end_headers()
+        self.wfile.write(b'hello')
+    monkeypatch.setattr(MockRequestHandler, 'do_GET', do_GET)
+
+    conn.send_request('GET', '/whatever')
+    with assert_logs('^Ignoring malformed header line', count=1):
+        resp = conn.read_response()
+    assert resp.status == 200
+    assert resp.headers['X-Before'] == 'one'
+    assert resp.headers['X-After'] == 'two'
+    assert 'no colon here' not in resp.headers
+    assert conn.readall() == b'hello'
+    assert not conn.response_pending()
+
+def test_http_headers():
+    hdr = dugong._parse_header('X-Foo: 1\r\nx-foo: 2\r\nSet-Cookie: a=1\r\n'
+                               'set-cookie: b=2\r\n  c=3\r\n')
+    assert hdr['X-FOO'] == '1, 2'
+    assert hdr['Set-Cookie'] == 'a=1'
+    assert hdr.get_all('Set-Cookie') == ['a=1', 'b=2 c=3']
+
+    hdr2 = hdr.copy()
+    assert isinstance(hdr2, dugong.HTTPHeaders)
+    assert hdr2.get_all('x-foo') == ['1', '2']
+
+    hdr['x-foo'] = '3'
+    assert hdr.get_all('X-Foo') == ['3']
+    del hdr['Set-Cookie']
+    assert hdr.get_all('Set-Cookie') is None
+    assert hdr2.get_all('Set-Cookie') == ['a=1', 'b=2 c=3']
+
+def test_cid_eq():
+    cid = CaseInsensitiveDict({'Content-Type': 'text/plain', 'ETag': 'foo'})
+    assert cid == CaseInsensitiveDict({'content-type': 'text/plain', 'etag': 'foo'})
+    assert cid == {'CONTENT-TYPE': 'text/plain', 'Etag': 'foo'}
+    assert cid != CaseInsensitiveDict({'Content-Type': 'text/plain', 'ETag': 'bar'})
+    assert cid != CaseInsensitiveDict({'Content-Type': 'text/plain', 'Date': 'foo'})
+    assert cid != CaseInsensitiveDict({'Content-Type': 'text/plain'})
+    assert cid != [('Content-Type', 'text/plain'), ('ETag', 'foo')]
+
+def test_cid_copy():
+    cid = CaseInsensitiveDict({'Content-Type': 'text/plain'})
+    cid2 = cid.copy()
+    assert cid2 == cid
+    assert list(cid2) == ['Content-Type']
+    cid2['content-type'] = 'text/html'
+    assert cid['Content-Type'] == 'text/plain'
+    assert cid2['Content-Type'] == 'text/html'
+
+def test_cid_repr():
+    cid = CaseInsensitiveDict({'Content-Type': 'text/plain', 'ETag': ('a', 1)})
+    assert repr(cid) == "CaseInsensitiveDict({'Content-Type': 'text/plain', 'ETag': ('a', 1)})"
+    assert repr(CaseInsensitiveDict()) == 'CaseInsensitiveDict({})'
+
+def test_is_temp_network_error():
+    assert dugong.is_temp_network_error(ConnectionResetError())
+    assert dugong.is_temp_network_error(ConnectionClosed())
+    assert dugong.is_temp_network_error(OSError(errno.EHOSTUNREACH, 'unreachable'))
+    assert not dugong.is_temp_network_error(OSError(errno.ENOENT, 'no such file'))
+    assert not dugong.is_temp_network_error(OSError())
+    assert not dugong.is_temp_network_error(ValueError())
+
 @pytest.fixture(params=(63,64,65,100,99,103,500,511,512,513))
 def buffer_size(request):
     return request.param
@@ -1089,11 +1338,17 @@ def test_send_timeout(conn, monkeypatch, random_fh):
 
 DUMMY_DATA = ','.join(str(x) for x in range(10000)).encode()
 
+# Path for which MockRequestHandler returns the given number of bytes
+SEND_BYTES_RE = re.compile(r'^/send_([0-9]+)_bytes')
+
 class MockRequestHandler(BaseHTTPRequestHandler):
 
     server_version = "MockHTTP"
     protocol_version = 'HTTP/1.1'
 
+    # Don't let Nagle's algorithm hold back small responses
+    disable_nagle_algorithm = True
+
     def log_message(self, format, *args):
         pass
 
@@ -1116,7 +1371,7 @@ class MockRequestHandler(BaseHTTPRequestHandler):
         if len_:
             self.rfile.read(len_)
 
-        hit = re.match(r'^/send_([0-9]+)_bytes', self.path)
+        hit = SEND_BYTES_RE.match(self.path)
         if hit:
             len_ = int(hit.group(1))
             self.do_HEAD()
@@ -1148,7 +1403,7 @@ class MockRequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
 
     def do_HEAD(self):
-        hit = re.match(r'^/send_([0-9]+)_bytes', self.path)
+        hit = SEND_BYTES_RE.match(self.path)
         if hit:
             len_ = int(hit.group(1))
             self.send_response(200)
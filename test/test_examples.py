@@ -20,7 +20,7 @@ import sys
 import pytest
 import threading
 from http.server import SimpleHTTPRequestHandler
-from socketserver import TCPServer
+from socketserver import ThreadingTCPServer
 
 try:
     import asyncio
@@ -32,16 +32,23 @@ basename = os.path.join(os.path.dirname(__file__), '..')
 class HTTPRequestHandler(SimpleHTTPRequestHandler):
     protocol_version = "HTTP/1.1"
 
+class HTTPServer(ThreadingTCPServer):
+    # Don't let handlers of connections that the examples have not
+    # closed yet block shutdown
+    daemon_threads = True
+
 class HTTPServerThread(threading.Thread):
     def __init__(self):
         super().__init__()
         self.host = 'localhost'
-        self.httpd = TCPServer((self.host, 0), HTTPRequestHandler)
+        self.httpd = HTTPServer((self.host, 0), HTTPRequestHandler)
         self.port = self.httpd.socket.getsockname()[1]
         self.url = 'http://%s:%d' % (self.host, self.port)
 
     def run(self):
-        self.httpd.serve_forever()
+        # Short poll interval, so that shutdown() does not have to
+        # wait long for the server loop to notice
+        self.httpd.serve_forever(poll_interval=0.05)
 
     def shutdown(self):
         self.httpd.shutdown()
@@ -58,14 +65,12 @@ def mock_server(request):
 def test_httpcat(mock_server):
     cmdline = [sys.executable, 'examples/httpcat.py',
                mock_server.url + '/setup.py' ]
-    with open('/dev/null', 'wb') as devnull:
-        subprocess.check_call(cmdline, stdout=devnull)
+    subprocess.check_call(cmdline, stdout=subprocess.DEVNULL)
 
 def test_extract_links(mock_server):
     cmdline = [sys.executable, 'examples/extract_links.py',
                mock_server.url + '/test/' ]
-    with open('/dev/null', 'wb') as devnull:
-        subprocess.check_call(cmdline, stdout=devnull)
+    subprocess.check_call(cmdline, stdout=subprocess.DEVNULL)
 
 @pytest.mark.skipif(asyncio is None,
                     reason='asyncio module not available')
@@ -76,5 +81,4 @@ def test_pipeline1(mock_server):
             name += '/' # avoid redirect
         cmdline.append('%s/test/%s' % (mock_server.url, name))
 
-    with open('/dev/null', 'wb') as devnull:
-        subprocess.check_call(cmdline, stdout=devnull)
+    subprocess.check_call(cmdline, stdout=subprocess.DEVNULL)